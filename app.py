@@ -2,16 +2,26 @@ import os
 import re
 import threading
 import time
-from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 from typing import Dict, Optional, Tuple
 
 import psycopg2
+import psycopg2.errors
 import psycopg2.extras
+import psycopg2.pool
+import redis
+import requests
+from cachetools import TTLCache
 from dotenv import load_dotenv
-from flask import Flask, abort, request
+from flask import Flask, abort, g, request
 from linebot import LineBotApi, WebhookHandler
 from linebot.exceptions import InvalidSignatureError
+from linebot.http_client import RequestsHttpClient, RequestsHttpResponse
 from linebot.models import MessageEvent, TextMessage, TextSendMessage
+from requests.adapters import HTTPAdapter
+
+from schema import ensure_schema
 
 # 讀取 .env
 load_dotenv()
@@ -21,17 +31,82 @@ app = Flask(__name__)
 CHANNEL_SECRET = os.getenv("LINE_CHANNEL_SECRET")
 CHANNEL_ACCESS_TOKEN = os.getenv("LINE_CHANNEL_ACCESS_TOKEN")
 DATABASE_URL = os.getenv("DATABASE_URL")
+# 連線池同時最多借出 DB_POOL_MAX 條；閒置時最多保留 DB_POOL_MIN 條（超過的歸還時會直接關閉），
+# 預設兩者相同，webhook 執行緒、背景配對與定期掃描同時使用時也不會反覆重新連線
+DB_POOL_MAX = int(os.getenv("DB_POOL_MAX", "10"))
+DB_POOL_MIN = min(int(os.getenv("DB_POOL_MIN", str(DB_POOL_MAX))), DB_POOL_MAX)
+# 額外的連線啟動參數（libpq options，如 "-c synchronous_commit=off"），預設不帶；經由 PgBouncer 等連線池時請勿設定
+DB_CONNECT_OPTIONS = os.getenv("DB_CONNECT_OPTIONS", "")
+# 背景配對與定期掃描等待資料列鎖的上限；webhook 的交易不受此限制
+MATCH_LOCK_TIMEOUT = "5s"
+REDIS_URL = os.getenv("REDIS_URL")
+# 登記流程狀態的逾時秒數，Redis 與本行程快取共用
+USER_STATE_TTL = int(os.getenv("USER_STATE_TTL", "1800"))
 
 if not CHANNEL_SECRET or not CHANNEL_ACCESS_TOKEN:
     raise RuntimeError("請先設定 LINE_CHANNEL_SECRET 與 LINE_CHANNEL_ACCESS_TOKEN")
 
-line_bot_api = LineBotApi(CHANNEL_ACCESS_TOKEN)
+
+class SessionHttpClient(RequestsHttpClient):
+    """以同一個 requests.Session 呼叫 LINE API，重複使用 keep-alive 連線，省去每次的 TLS 交握。"""
+
+    def __init__(self, timeout=RequestsHttpClient.DEFAULT_TIMEOUT):
+        super().__init__(timeout)
+        self.session = requests.Session()
+        # 推播執行緒與 webhook 執行緒同時呼叫時，每個 host 最多保留 32 條連線，避免用完即丟
+        self.session.mount("https://", HTTPAdapter(pool_connections=8, pool_maxsize=32))
+
+    def get(self, url, headers=None, params=None, stream=False, timeout=None):
+        response = self.session.get(
+            url, headers=headers, params=params, stream=stream, timeout=timeout or self.timeout
+        )
+        return RequestsHttpResponse(response)
+
+    def post(self, url, headers=None, data=None, timeout=None):
+        response = self.session.post(url, headers=headers, data=data, timeout=timeout or self.timeout)
+        return RequestsHttpResponse(response)
+
+    def put(self, url, headers=None, data=None, timeout=None):
+        response = self.session.put(url, headers=headers, data=data, timeout=timeout or self.timeout)
+        return RequestsHttpResponse(response)
+
+    def delete(self, url, headers=None, data=None, timeout=None):
+        response = self.session.delete(url, headers=headers, data=data, timeout=timeout or self.timeout)
+        return RequestsHttpResponse(response)
+
+
+# (連線逾時, 讀取逾時) 秒；LINE API 卡住時不要拖住 worker
+LINE_API_TIMEOUT = (1, 3)
+
+line_bot_api = LineBotApi(CHANNEL_ACCESS_TOKEN, timeout=LINE_API_TIMEOUT, http_client=SessionHttpClient)
 handler = WebhookHandler(CHANNEL_SECRET)
 
+# 主動推播改由背景執行緒送出，webhook 不必等待 LINE API 回應
+push_executor = ThreadPoolExecutor(max_workers=8)
+# 配對搜尋同樣移到背景執行，webhook 回覆後即可回傳 OK
+match_executor = ThreadPoolExecutor(max_workers=4)
+
 PLACE_ALLOWED = {"MAYDAY LAND": "MAYDAY LAND", "洲際棒球場": "洲際棒球場", "皆可": "皆可"}
+# 地點輸入（轉大寫、去空白後）對應的標準名稱，含代號 1/2/3 的各種寫法
+PLACE_ALIASES = {
+    **{alias: "MAYDAY LAND" for alias in ("1", "1.", "1、", "1)")},
+    **{alias: "洲際棒球場" for alias in ("2", "2.", "2、", "2)")},
+    **{alias: "皆可" for alias in ("3", "3.", "3、", "3)")},
+    **{name.upper().replace(" ", ""): name for name in PLACE_ALLOWED.values()},
+}
 PLACE_OPTIONS_ORIG_TEXT = "地點僅接受：1. MAYDAY LAND  2. 洲際棒球場，可直接輸入代號"
 PLACE_OPTIONS_DESIRED_TEXT = "地點僅接受：1. MAYDAY LAND  2. 洲際棒球場  3. 皆可，可直接輸入代號"
 DISCLAIMER = "本系統僅提供扭蛋交換配對功能，不負責任合金流活動，亦不負任何法律責任"
+DUPLICATE_ORDER_ERROR = "此扭蛋訂單編號已登記，請使用不同的 9 碼編號。"
+MATCH_MESSAGE_TEMPLATE = (
+    "【扭蛋交換配對成功】\n"
+    "對方聯繫方式：{contact}\n"
+    "對方訂單編號：{order_no}\n"
+    "對方原登記：{orig_date} {orig_slot} / {orig_place}\n"
+    "對方希望交換：{desired_text} / {desired_place}\n"
+    "請盡快互相聯繫以保障安全。\n\n"
+    f"{DISCLAIMER}"
+)
 
 FIELD_FLOW: Tuple[Tuple[str, str], ...] = (
     ("contact", "聯繫方式"),
@@ -56,30 +131,89 @@ FIELD_HINTS = {
 }
 
 FIELD_LABEL_MAP = {label: key for key, label in FIELD_FLOW}
+FIELD_LABEL_WITH_HINT = {key: f"{label}{FIELD_HINTS.get(key, '')}" for key, label in FIELD_FLOW}
+# (序號, key, 含提示的欄位名稱)，產生範本與摘要時直接走訪
+FIELD_FLOW_WITH_HINTS: Tuple[Tuple[int, str, str], ...] = tuple(
+    (idx, key, FIELD_LABEL_WITH_HINT[key]) for idx, (key, _label) in enumerate(FIELD_FLOW, start=1)
+)
 
-# key = line_user_id, value = {"mode": str}
-user_states: Dict[str, Dict[str, str]] = {}
+LABEL_HINT_RE = re.compile(r"\s*（.*?）|\s*\(.*?\)")
+MULTI_VALUE_SEP_RE = re.compile(r"[、,]")
+# 每個欄位自「數字.」開頭的行起算，直到下一個「數字.」開頭的行為止
+FORM_CHUNK_RE = re.compile(r"^[^\S\n]*\d+\..*?(?=^[^\S\n]*\d+\.|\Z)", re.M | re.S)
+FORM_FIELD_RE = re.compile(r"^\s*\d+\.\s*(?P<label>(?:[^:：()]|\([^)]*\))+)\s*[:：]\s*(?P<value>.*)$", re.S)
+
+# 設定 REDIS_URL 時登記流程狀態存於 Redis（多個 worker 共用，逾時自動清除）；
+# 未設定時退回本行程記憶體，僅適用單一 worker
+redis_client = redis.Redis.from_url(REDIS_URL, decode_responses=True) if REDIS_URL else None
+
+# key = line_user_id, value = mode；上限筆數並與 Redis 相同逾時，未完成的登記不會無限累積
+# gthread worker 內多執行緒共用，存取須持鎖
+user_states: TTLCache = TTLCache(maxsize=10_000, ttl=USER_STATE_TTL)
+user_states_lock = threading.RLock()
 
 
 # ===== 輔助函式 =====
 
 def label_with_hint(key: str) -> str:
-    label = next(label for k, label in FIELD_FLOW if k == key)
-    hint = FIELD_HINTS.get(key)
-    return f"{label}{hint}" if hint else label
+    return FIELD_LABEL_WITH_HINT[key]
 
 
 def canonicalize_label(label: str) -> str:
-    # 移除括號提示字串，取得欄位本名
-    return re.sub(r"\s*（.*?）|\s*\(.*?\)", "", label).strip()
+    # 沒有括號時不必跑正規表示式；有括號時移除括號提示字串，取得欄位本名
+    if "(" not in label and "（" not in label:
+        return label.strip()
+    return LABEL_HINT_RE.sub("", label).strip()
+
+
+CANONICAL_LABEL_MAP = {canonicalize_label(label): key for key, label in FIELD_FLOW}
+# 直接貼上範本或只填欄位名稱時可完全比對，不必再跑正規表示式
+EXACT_LABEL_MAP = {**{hinted: key for key, hinted in FIELD_LABEL_WITH_HINT.items()}, **FIELD_LABEL_MAP}
 
 
 def label_to_key(label: str) -> Optional[str]:
-    canonical = canonicalize_label(label)
-    for key, base_label in FIELD_FLOW:
-        if canonicalize_label(base_label) == canonical:
-            return key
-    return None
+    key = EXACT_LABEL_MAP.get(label)
+    if key is not None:
+        return key
+    return CANONICAL_LABEL_MAP.get(canonicalize_label(label))
+
+
+def user_state_key(line_user_id: str) -> str:
+    return f"gacha:state:{line_user_id}"
+
+
+def get_user_mode(line_user_id: str) -> Optional[str]:
+    if redis_client is not None:
+        return redis_client.get(user_state_key(line_user_id))
+    with user_states_lock:
+        return user_states.get(line_user_id)
+
+
+def set_user_mode(line_user_id: str, mode: str):
+    if redis_client is not None:
+        redis_client.setex(user_state_key(line_user_id), USER_STATE_TTL, mode)
+        return
+    with user_states_lock:
+        user_states[line_user_id] = mode
+
+
+def clear_user_mode(line_user_id: str):
+    if redis_client is not None:
+        redis_client.delete(user_state_key(line_user_id))
+        return
+    with user_states_lock:
+        user_states.pop(line_user_id, None)
+
+
+def push_text(line_user_id: str, text: str, error_prefix: str):
+    try:
+        line_bot_api.push_message(line_user_id, TextSendMessage(text=text))
+    except Exception as exc:
+        print(error_prefix, exc)
+
+
+def push_text_async(line_user_id: str, text: str, error_prefix: str = "push_message 發送失敗："):
+    push_executor.submit(push_text, line_user_id, text, error_prefix)
 
 
 def place_options_text(key: str) -> str:
@@ -88,69 +222,100 @@ def place_options_text(key: str) -> str:
 
 # ===== 資料庫工具 =====
 
+# 查詢只取出程式會用到的欄位，不使用 SELECT *
+REQUEST_COLUMNS = (
+    "id, line_user_id, contact, order_no, orig_date, orig_slot, orig_place, "
+    "desired_date, desired_slot, desired_place, status, match_id"
+)
+# 以 RETURNING 直接取回新增的資料；SQL 於載入時組好，每次登記不必重新格式化
+INSERT_REQUEST_SQL = f"""
+    INSERT INTO exchange_requests (
+        line_user_id, contact, order_no,
+        orig_date, orig_slot, orig_place,
+        desired_date, desired_slot, desired_place,
+        status
+    ) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, 'pending')
+    RETURNING {REQUEST_COLUMNS}
+"""
+
+
 def init_db():
     if not DATABASE_URL:
         raise RuntimeError("未設定 DATABASE_URL，請先於環境變數設定 PostgreSQL 連線字串")
     conn = psycopg2.connect(DATABASE_URL, cursor_factory=psycopg2.extras.DictCursor)
-    cur = conn.cursor()
-    cur.execute(
-        """
-        CREATE TABLE IF NOT EXISTS exchange_requests (
-            id SERIAL PRIMARY KEY,
-            line_user_id TEXT NOT NULL,
-            contact TEXT NOT NULL,
-            order_no TEXT NOT NULL,
-            orig_date TEXT NOT NULL,
-            orig_slot TEXT NOT NULL,
-            orig_place TEXT NOT NULL DEFAULT '',
-            desired_date TEXT NOT NULL,
-            desired_slot TEXT NOT NULL,
-            desired_place TEXT NOT NULL DEFAULT '',
-            status TEXT NOT NULL DEFAULT 'pending',
-            match_id INTEGER,
-            created_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
-        )
-        """
-    )
-    cur.execute("ALTER TABLE exchange_requests ADD COLUMN IF NOT EXISTS orig_place TEXT NOT NULL DEFAULT ''")
-    cur.execute("ALTER TABLE exchange_requests ADD COLUMN IF NOT EXISTS desired_place TEXT NOT NULL DEFAULT ''")
-    cur.execute("ALTER TABLE exchange_requests ADD COLUMN IF NOT EXISTS created_at TIMESTAMPTZ NOT NULL DEFAULT NOW()")
-    cur.execute("ALTER TABLE exchange_requests DROP COLUMN IF EXISTS verif_code")
-    cur.execute(
-        """
-        CREATE TABLE IF NOT EXISTS match_blocks (
-            id SERIAL PRIMARY KEY,
-            req_id_a INTEGER NOT NULL,
-            req_id_b INTEGER NOT NULL,
-            created_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
-            CONSTRAINT uniq_pair UNIQUE (req_id_a, req_id_b)
-        )
-        """
-    )
-    cur.execute("ALTER TABLE exchange_requests DROP COLUMN IF EXISTS phone")
-    cur.execute("ALTER TABLE exchange_requests DROP COLUMN IF EXISTS email")
-    conn.commit()
-    cur.close()
+    ensure_schema(conn)
     conn.close()
 
 
+_db_pool: Optional[psycopg2.pool.ThreadedConnectionPool] = None
+_db_pool_lock = threading.Lock()
+# 連線全數借出時讓後來的執行緒排隊等待，而不是直接丟出 PoolError
+_db_pool_slots = threading.BoundedSemaphore(DB_POOL_MAX)
+
+
+def get_db_pool() -> psycopg2.pool.ThreadedConnectionPool:
+    global _db_pool
+    if _db_pool is None:
+        with _db_pool_lock:
+            if _db_pool is None:
+                if not DATABASE_URL:
+                    raise RuntimeError("未設定 DATABASE_URL，請先於環境變數設定 PostgreSQL 連線字串")
+                connect_kwargs = {"cursor_factory": psycopg2.extras.DictCursor}
+                if DB_CONNECT_OPTIONS:
+                    connect_kwargs["options"] = DB_CONNECT_OPTIONS
+                _db_pool = psycopg2.pool.ThreadedConnectionPool(DB_POOL_MIN, DB_POOL_MAX, DATABASE_URL, **connect_kwargs)
+    return _db_pool
+
+
+def checkout_db_conn(pool: psycopg2.pool.ThreadedConnectionPool):
+    # 資料庫重啟或閒置連線被中斷後，池中的連線可能已失效；借出前以 SELECT 1 確認，失效的丟棄後改取下一條
+    for _ in range(DB_POOL_MAX + 1):
+        conn = pool.getconn()
+        if not conn.closed:
+            try:
+                conn.autocommit = True
+                cur = conn.cursor()
+                cur.execute("SELECT 1")
+                cur.close()
+                conn.autocommit = False
+                return conn
+            except psycopg2.Error as exc:
+                print("捨棄失效的資料庫連線：", exc)
+        pool.putconn(conn, close=True)
+    raise psycopg2.OperationalError("無法取得可用的資料庫連線")
+
+
 def get_db_conn():
-    if not DATABASE_URL:
-        raise RuntimeError("未設定 DATABASE_URL，請先於環境變數設定 PostgreSQL 連線字串")
-    return psycopg2.connect(DATABASE_URL, cursor_factory=psycopg2.extras.DictCursor)
+    # 同一個 app context（一次 webhook 或一輪定期掃描）共用一條連線，結束時歸還連線池
+    if "db" not in g:
+        _db_pool_slots.acquire()
+        try:
+            g.db = checkout_db_conn(get_db_pool())
+        except Exception:
+            _db_pool_slots.release()
+            raise
+    return g.db
+
+
+@app.teardown_appcontext
+def release_db_conn(_exc):
+    conn = g.pop("db", None)
+    if conn is not None:
+        # 已斷線的連線直接丟棄，不放回連線池
+        get_db_pool().putconn(conn, close=bool(conn.closed))
+        _db_pool_slots.release()
 
 
 def has_pending_request(line_user_id: str) -> bool:
     conn = get_db_conn()
     cur = conn.cursor()
     cur.execute(
-        "SELECT COUNT(*) FROM exchange_requests WHERE line_user_id = %s AND status = 'pending'",
+        "SELECT 1 FROM exchange_requests WHERE line_user_id = %s AND status = 'pending' LIMIT 1",
         (line_user_id,),
     )
-    count = cur.fetchone()[0]
+    exists = cur.fetchone() is not None
     cur.close()
-    conn.close()
-    return count > 0
+    return exists
 
 
 def cancel_pending_request(line_user_id: str) -> int:
@@ -163,7 +328,6 @@ def cancel_pending_request(line_user_id: str) -> int:
     deleted = cur.rowcount
     conn.commit()
     cur.close()
-    conn.close()
     return deleted
 
 
@@ -171,12 +335,11 @@ def order_no_exists(line_user_id: str, order_no: str) -> bool:
     conn = get_db_conn()
     cur = conn.cursor()
     cur.execute(
-        "SELECT COUNT(*) FROM exchange_requests WHERE line_user_id = %s AND order_no = %s",
+        "SELECT 1 FROM exchange_requests WHERE line_user_id = %s AND order_no = %s LIMIT 1",
         (line_user_id, order_no),
     )
-    exists = cur.fetchone()[0] > 0
+    exists = cur.fetchone() is not None
     cur.close()
-    conn.close()
     return exists
 
 
@@ -184,8 +347,8 @@ def get_request_by_order(line_user_id: str, order_no: str):
     conn = get_db_conn()
     cur = conn.cursor()
     cur.execute(
-        """
-        SELECT * FROM exchange_requests
+        f"""
+        SELECT {REQUEST_COLUMNS} FROM exchange_requests
         WHERE line_user_id = %s AND order_no = %s
         ORDER BY id DESC
         LIMIT 1
@@ -194,7 +357,6 @@ def get_request_by_order(line_user_id: str, order_no: str):
     )
     row = cur.fetchone()
     cur.close()
-    conn.close()
     return row
 
 
@@ -205,49 +367,52 @@ def delete_pending_by_id(req_id: int) -> int:
     deleted = cur.rowcount
     conn.commit()
     cur.close()
-    conn.close()
     return deleted
 
 
-def insert_request(data: Dict[str, str], line_user_id: str) -> int:
+def register_and_match(data: Dict[str, str], line_user_id: str):
+    # 新增資料與配對在同一交易內完成，回傳 (新資料, 配對對象或 None)；訂單編號重複時回傳 (None, None)
     conn = get_db_conn()
     cur = conn.cursor()
-    cur.execute(
-        """
-        INSERT INTO exchange_requests (
-            line_user_id, contact, order_no,
-            orig_date, orig_slot, orig_place,
-            desired_date, desired_slot, desired_place,
-            status
-        ) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, 'pending')
-        RETURNING id
-        """,
-        (
-            line_user_id,
-            data["contact"],
-            data["order_no"],
-            data["orig_date"],
-            data["orig_slot"],
-            data["orig_place"],
-            data["desired_date"],
-            data["desired_slot"],
-            data["desired_place"],
-        ),
+    try:
+        cur.execute(
+            INSERT_REQUEST_SQL,
+            (
+                line_user_id,
+                data["contact"],
+                data["order_no"],
+                data["orig_date"],
+                data["orig_slot"],
+                data["orig_place"],
+                data["desired_date"],
+                data["desired_slot"],
+                data["desired_place"],
+            ),
+        )
+    except psycopg2.errors.UniqueViolation:
+        # 同一訂單同時送出兩次時，由 idx_exchange_user_order 擋下後送出的那筆
+        conn.rollback()
+        cur.close()
+        return None, None
+    row = cur.fetchone()
+    psycopg2.extras.execute_values(
+        cur,
+        "INSERT INTO desired_slots (req_id, desired_date, desired_slot) VALUES %s ON CONFLICT DO NOTHING",
+        [(row["id"], d, s) for d, s in build_desired_pairs(data)],
     )
-    new_id = cur.fetchone()[0]
+    matched_row, partner = claim_match(cur, row)
     conn.commit()
     cur.close()
-    conn.close()
-    return new_id
+    # 已配對時回傳更新後的資料（status、match_id 為最新值）
+    return matched_row or row, partner
 
 
 def get_request_by_id(req_id: int):
     conn = get_db_conn()
     cur = conn.cursor()
-    cur.execute("SELECT * FROM exchange_requests WHERE id = %s", (req_id,))
+    cur.execute(f"SELECT {REQUEST_COLUMNS} FROM exchange_requests WHERE id = %s", (req_id,))
     row = cur.fetchone()
     cur.close()
-    conn.close()
     return row
 
 
@@ -257,12 +422,11 @@ def get_partner(req) -> Optional[dict]:
     conn = get_db_conn()
     cur = conn.cursor()
     cur.execute(
-        "SELECT * FROM exchange_requests WHERE match_id = %s AND id != %s LIMIT 1",
+        f"SELECT {REQUEST_COLUMNS} FROM exchange_requests WHERE match_id = %s AND id != %s LIMIT 1",
         (req["match_id"], req["id"]),
     )
     partner = cur.fetchone()
     cur.close()
-    conn.close()
     return partner
 
 
@@ -280,29 +444,14 @@ def add_block_pair(id1: int, id2: int):
     )
     conn.commit()
     cur.close()
-    conn.close()
-
-
-def is_blocked_pair(id1: int, id2: int) -> bool:
-    a, b = sorted((id1, id2))
-    conn = get_db_conn()
-    cur = conn.cursor()
-    cur.execute(
-        "SELECT 1 FROM match_blocks WHERE req_id_a = %s AND req_id_b = %s LIMIT 1",
-        (a, b),
-    )
-    blocked = cur.fetchone() is not None
-    cur.close()
-    conn.close()
-    return blocked
 
 
 def unbind_match(line_user_id: str, order_no: str, partner_order: str):
     conn = get_db_conn()
     cur = conn.cursor()
     cur.execute(
-        """
-        SELECT * FROM exchange_requests
+        f"""
+        SELECT {REQUEST_COLUMNS} FROM exchange_requests
         WHERE line_user_id = %s AND order_no = %s AND status = 'matched'
         LIMIT 1
         """,
@@ -311,17 +460,14 @@ def unbind_match(line_user_id: str, order_no: str, partner_order: str):
     me = cur.fetchone()
     if not me:
         cur.close()
-        conn.close()
         return None, None, "查無配對中的此訂單，無法解除。"
 
     partner = get_partner(me)
     if not partner or partner["status"] != "matched":
         cur.close()
-        conn.close()
         return None, None, "查無對應的配對對象，請稍後再試。"
     if partner["order_no"] != partner_order:
         cur.close()
-        conn.close()
         return None, None, "對方訂單編號不符，無法解除。"
 
     cur.execute(
@@ -330,53 +476,50 @@ def unbind_match(line_user_id: str, order_no: str, partner_order: str):
     )
     conn.commit()
     cur.close()
-    conn.close()
     add_block_pair(me["id"], partner["id"])
     return me, partner, None
 
 
-def fetch_pending_ids_ordered() -> list:
+def fetch_pending_requests_ordered() -> list:
+    # 直接取回整筆資料交給 try_match_and_notify，不必逐筆再查詢
     conn = get_db_conn()
     cur = conn.cursor()
     cur.execute(
-        "SELECT id FROM exchange_requests WHERE status = 'pending' ORDER BY created_at ASC, id ASC"
+        f"SELECT {REQUEST_COLUMNS} FROM exchange_requests WHERE status = 'pending' ORDER BY created_at ASC, id ASC"
     )
     rows = cur.fetchall()
     cur.close()
-    conn.close()
-    return [row["id"] for row in rows]
+    return rows
 
 
 def periodic_match_loop():
     while True:
         try:
-            pending_ids = fetch_pending_ids_ordered()
-            for pid in pending_ids:
-                try_match_and_notify(pid)
+            with app.app_context():
+                pending = fetch_pending_requests_ordered()
+                # 待配對不足兩筆時不可能配對成功，略過本輪
+                if len(pending) >= 2:
+                    matched_ids = set()
+                    for row in pending:
+                        # 本輪已被配對走的資料略過；其餘狀態變化由 claim_match 的條件式更新把關
+                        if row["id"] in matched_ids:
+                            continue
+                        try:
+                            other = try_match_and_notify(row["id"], row)
+                        except (psycopg2.errors.LockNotAvailable, psycopg2.errors.DeadlockDetected) as exc:
+                            # 鎖定逾時只放棄這一筆，繼續處理其餘待配對資料
+                            get_db_conn().rollback()
+                            print("定期配對鎖定失敗，略過：", row["id"], exc)
+                            continue
+                        if other:
+                            matched_ids.add(other["id"])
         except Exception as exc:
             print("定期配對掃描失敗：", exc)
         time.sleep(60)
 
 
 def normalize_place(raw: str) -> Optional[str]:
-    cleaned = raw.strip()
-    if not cleaned:
-        return None
-
-    normalized = cleaned.upper().replace(" ", "")
-    if normalized in {"1", "1.", "1、", "1)", "MAYDAYLAND"}:
-        return "MAYDAY LAND"
-    if normalized in {"2", "2.", "2、", "2)", "洲際棒球場"}:
-        return "洲際棒球場"
-    if normalized in {"3", "3.", "3、", "3)", "皆可"}:
-        return "皆可"
-
-    # 使用者直接輸入名稱時保留原大小寫，英文比對後轉為標準格式
-    if cleaned.upper() in PLACE_ALLOWED:
-        return PLACE_ALLOWED[cleaned.upper()]
-    if cleaned in PLACE_ALLOWED:
-        return PLACE_ALLOWED[cleaned]
-    return None
+    return PLACE_ALIASES.get(raw.strip().upper().replace(" ", ""))
 
 
 def normalize_order_no(raw: str) -> Optional[str]:
@@ -386,34 +529,44 @@ def normalize_order_no(raw: str) -> Optional[str]:
     return cleaned
 
 
+def is_short_number(text: str) -> bool:
+    # 等同正規表示式的 \d{1,2}
+    return text.isdecimal() and 1 <= len(text) <= 2
+
+
 def normalize_date(raw: str) -> Optional[str]:
-    cleaned = raw.strip().replace("-", "/")
-    match = re.match(r"^\s*(?:(\d{4})/)?(\d{1,2})/(\d{1,2})\s*$", cleaned)
-    if not match:
+    parts = raw.strip().replace("-", "/").split("/")
+    if len(parts) == 3:
+        year_str = parts.pop(0)
+        if not (year_str.isdecimal() and len(year_str) == 4):
+            return None
+    if len(parts) != 2 or not all(is_short_number(part) for part in parts):
         return None
 
-    _year_str, month_str, day_str = match.groups()
-    month, day = int(month_str), int(day_str)
+    month, day = int(parts[0]), int(parts[1])
+    # 1 月與 12 月皆為 31 天，不需再建立 datetime 驗證
     if month not in {1, 12}:
         return None
     if not (1 <= day <= 31):
         return None
+    return f"{month:02d}/{day:02d}"
 
-    try:
-        dt = datetime(2024 if month == 12 else 2025, month, day)
-    except ValueError:
+
+def parse_clock(text: str) -> Optional[Tuple[int, int]]:
+    hour_str, sep, minute_str = text.strip().partition(":")
+    if not sep or not is_short_number(hour_str) or not is_short_number(minute_str):
         return None
-    return dt.strftime("%m/%d")
+    return int(hour_str), int(minute_str)
 
 
 def normalize_slot(raw: str) -> Tuple[Optional[str], Optional[str]]:
-    cleaned = raw.strip()
-    pattern = re.compile(r"^\s*(\d{1,2}):(\d{1,2})\s*[~\-]\s*(\d{1,2}):(\d{1,2})\s*$")
-    match = pattern.match(cleaned)
-    if not match:
+    parts = raw.strip().replace("-", "~").split("~")
+    start = parse_clock(parts[0]) if len(parts) == 2 else None
+    end = parse_clock(parts[1]) if start else None
+    if not end:
         return None, "格式需為 hh:mm~hh:mm（24小時制）。"
 
-    h1, m1, h2, m2 = map(int, match.groups())
+    (h1, m1), (h2, m2) = start, end
     if not (0 <= h1 < 24 and 0 <= h2 < 24 and 0 <= m1 < 60 and 0 <= m2 < 60):
         return None, "時段需為 24 小時制。"
     if (h1, m1) >= (h2, m2):
@@ -423,7 +576,7 @@ def normalize_slot(raw: str) -> Tuple[Optional[str], Optional[str]]:
 
 
 def split_multi_values(raw: str) -> list:
-    return [part.strip() for part in re.split(r"[、,]", raw) if part.strip()]
+    return [part.strip() for part in MULTI_VALUE_SEP_RE.split(raw) if part.strip()]
 
 
 def normalize_desired_dates(raw: str) -> Tuple[Optional[list], Optional[str]]:
@@ -510,33 +663,38 @@ def validate_field(key: str, value: str, data: Optional[Dict[str, str]] = None)
 
 
 def build_form_template() -> str:
-    lines = [f"{idx + 1}. {label_with_hint(key)}: " for idx, (key, _label) in enumerate(FIELD_FLOW)]
+    lines = [f"{idx}. {hinted}: " for idx, _key, hinted in FIELD_FLOW_WITH_HINTS]
     return "\n".join(lines)
 
 
-def format_summary(data: Dict[str, str]) -> str:
+FORM_TEMPLATE = build_form_template()
+
+
+def format_summary(data) -> str:
+    # data 可為 dict 或 DictRow，直接以欄位名稱取值，不必另建 dict
     lines = []
-    for idx, (key, _label) in enumerate(FIELD_FLOW, start=1):
+    for idx, key, hinted in FIELD_FLOW_WITH_HINTS:
         value = data.get(key, "")
         if key == "desired_date":
             value = format_desired_pairs_text(data) or value
         if key == "desired_slot":
             continue
-        lines.append(f"{idx}. {label_with_hint(key)}: {value}")
+        lines.append(f"{idx}. {hinted}: {value}")
     return "\n".join(lines)
 
 
+@lru_cache(maxsize=1024)
+def parse_desired_pairs(desired_date: str, desired_slot: str) -> Tuple[Tuple[str, str], ...]:
+    # 同一筆資料會在確認、查詢、配對通知中重複顯示，解析結果依原字串快取
+    return tuple(zip(split_multi_values(desired_date), split_multi_values(desired_slot)))
+
+
 def build_desired_pairs(record) -> list:
-    dates = split_multi_values(record["desired_date"])
-    slots = split_multi_values(record["desired_slot"])
-    pairs = []
-    for idx in range(min(len(dates), len(slots))):
-        pairs.append((dates[idx], slots[idx]))
-    return pairs
+    return list(parse_desired_pairs(record["desired_date"], record["desired_slot"]))
 
 
 def format_desired_pairs_text(record) -> str:
-    pairs = build_desired_pairs(record)
+    pairs = parse_desired_pairs(record["desired_date"], record["desired_slot"])
     if not pairs:
         return ""
     return "、".join(f"{d}:{s}" for d, s in pairs)
@@ -546,24 +704,11 @@ def parse_form_input(text: str) -> Tuple[Dict[str, str], list]:
     data: Dict[str, str] = {}
     errors: list = []
 
-    chunks = []
-    current = []
-    for line in text.splitlines():
-        if re.match(r"^\s*\d+\.", line):
-            if current:
-                chunks.append("\n".join(current))
-                current = []
-        if line.strip():
-            current.append(line.strip())
-    if current:
-        chunks.append("\n".join(current))
-
-    for chunk in chunks:
-        m = re.match(
-            r"^\s*\d+\.\s*(?P<label>(?:[^:：()]|\([^)]*\))+)\s*[:：]\s*(?P<value>.*)$",
-            chunk,
-            flags=re.S,
-        )
+    # 先以 splitlines 統一換行（含 \r、\u2028 等），FORM_CHUNK_RE 的 ^ 只認得 \n
+    text = "\n".join(text.splitlines())
+    for chunk_match in FORM_CHUNK_RE.finditer(text):
+        chunk = "\n".join(line.strip() for line in chunk_match.group().splitlines() if line.strip())
+        m = FORM_FIELD_RE.match(chunk)
         if not m:
             continue
         label, value = m.group("label").strip(), m.group("value").strip()
@@ -595,11 +740,7 @@ def parse_single_field_input(key: str, text: str, data: Optional[Dict[str, str]]
     if not stripped:
         return None, f"{label_with_hint(key)} 不可空白。"
 
-    pattern = re.compile(
-        r"^\s*\d+\.\s*(?P<label>(?:[^:：()]|\([^)]*\))+)\s*[:：]\s*(?P<value>.*)$",
-        re.S,
-    )
-    match = pattern.match(stripped)
+    match = FORM_FIELD_RE.match(stripped)
     if match:
         label = match.group("label").strip()
         value = match.group("value").strip()
@@ -612,93 +753,130 @@ def parse_single_field_input(key: str, text: str, data: Optional[Dict[str, str]]
 
 
 def build_match_message(me, partner) -> str:
-    return (
-        "【扭蛋交換配對成功】\n"
-        f"對方聯繫方式：{partner['contact']}\n"
-        f"對方訂單編號：{partner['order_no']}\n"
-        f"對方原登記：{partner['orig_date']} {partner['orig_slot']} / {partner['orig_place']}\n"
-        f"對方希望交換：{format_desired_pairs_text(partner)} / {partner['desired_place']}\n"
-        "請盡快互相聯繫以保障安全。\n\n"
-        f"{DISCLAIMER}"
+    return MATCH_MESSAGE_TEMPLATE.format(
+        contact=partner["contact"],
+        order_no=partner["order_no"],
+        orig_date=partner["orig_date"],
+        orig_slot=partner["orig_slot"],
+        orig_place=partner["orig_place"],
+        desired_text=format_desired_pairs_text(partner),
+        desired_place=partner["desired_place"],
     )
 
 
-def try_match_and_notify(new_id: int):
-    conn = get_db_conn()
-    cur = conn.cursor()
-    cur.execute("SELECT * FROM exchange_requests WHERE id = %s", (new_id,))
-    me = cur.fetchone()
-    if not me or me["status"] != "pending":
-        cur.close()
-        conn.close()
-        return False
-
-    me_pairs = build_desired_pairs(me)
-
+def claim_match(cur, me):
+    # 在呼叫端的交易內尋找並鎖定配對對象、更新雙方狀態；由呼叫端負責 commit
+    # 配對成功時回傳 (更新後的我, 對方)，否則回傳 (None, None)
+    # 先鎖定自己這筆（已非 pending 就放棄），再以 FOR UPDATE SKIP LOCKED 鎖定候選資料；
+    # 各方都先鎖自己，互為候選的兩個配對不會互相等待而死結。查詢、更新與取回對方資料合併為一次往返
+    # 對方的原登記需在我的希望清單內、我的原登記需在對方的希望清單內，地點互相符合，且未曾解除過配對
     cur.execute(
-        """
-        SELECT * FROM exchange_requests
-        WHERE status = 'pending' AND id != %s
-        ORDER BY created_at ASC, id ASC
+        f"""
+        SAVEPOINT claim_match;
+        WITH locked_me AS (
+            SELECT id FROM exchange_requests
+            WHERE id = %(id)s AND status = 'pending'
+            FOR UPDATE
+        ),
+        candidate AS (
+            SELECT r.id AS partner_id FROM exchange_requests r
+            JOIN desired_slots theirs
+              ON theirs.req_id = r.id
+             AND theirs.desired_date = %(orig_date)s
+             AND theirs.desired_slot = %(orig_slot)s
+            WHERE EXISTS (SELECT 1 FROM locked_me)
+              AND r.status = 'pending'
+              AND r.id != %(id)s
+              AND r.line_user_id != %(line_user_id)s
+              AND (r.desired_place = '皆可' OR r.desired_place = %(orig_place)s)
+              AND (%(desired_place)s = '皆可' OR r.orig_place = %(desired_place)s)
+              AND EXISTS (
+                  SELECT 1 FROM desired_slots mine
+                  WHERE mine.req_id = %(id)s
+                    AND mine.desired_date = r.orig_date
+                    AND mine.desired_slot = r.orig_slot
+              )
+              AND NOT EXISTS (
+                  SELECT 1 FROM match_blocks b
+                  WHERE b.req_id_a = LEAST(r.id, %(id)s) AND b.req_id_b = GREATEST(r.id, %(id)s)
+              )
+            ORDER BY r.created_at ASC, r.id ASC
+            LIMIT 1
+            FOR UPDATE OF r SKIP LOCKED
+        )
+        UPDATE exchange_requests
+        SET status = 'matched', match_id = LEAST(%(id)s, candidate.partner_id)
+        FROM candidate
+        WHERE exchange_requests.id IN (%(id)s, candidate.partner_id)
+          AND exchange_requests.status = 'pending'
+        RETURNING {REQUEST_COLUMNS}
         """,
-        (me["id"],),
+        {
+            "id": me["id"],
+            "line_user_id": me["line_user_id"],
+            "orig_date": me["orig_date"],
+            "orig_slot": me["orig_slot"],
+            "orig_place": me["orig_place"],
+            "desired_place": me["desired_place"],
+        },
     )
-    fetched = cur.fetchall()
-    candidates = [row for row in fetched if row["line_user_id"] != me["line_user_id"]]
+    if cur.rowcount == 0:
+        return None, None
+    if cur.rowcount != 2:
+        # 其中一筆已被同時進行的配對搶先，只撤回這次更新，放棄本次配對
+        cur.execute("ROLLBACK TO SAVEPOINT claim_match")
+        return None, None
+    rows = cur.fetchall()
+    matched_me = next(row for row in rows if row["id"] == me["id"])
+    other = next(row for row in rows if row["id"] != me["id"])
+    return matched_me, other
 
-    other = None
 
-    def place_ok(orig_place: str, desired_place: str) -> bool:
-        return desired_place == "皆可" or orig_place == desired_place
+def notify_match(me, other):
+    push_text_async(me["line_user_id"], build_match_message(me, other))
+    push_text_async(other["line_user_id"], build_match_message(other, me))
 
-    for cand in candidates:
-        if is_blocked_pair(me["id"], cand["id"]):
-            continue
-        if not place_ok(cand["orig_place"], me["desired_place"]):
-            continue
-        if not place_ok(me["orig_place"], cand["desired_place"]):
-            continue
 
-        cand_pairs = build_desired_pairs(cand)
-        me_to_other_ok = any(
-            cand["orig_date"] == d and cand["orig_slot"] == s for d, s in me_pairs
-        )
-        other_to_me_ok = any(
-            me["orig_date"] == d and me["orig_slot"] == s for d, s in cand_pairs
-        )
-
-        if me_to_other_ok and other_to_me_ok:
-            other = cand
-            break
+def try_match_and_notify(new_id: int, me=None):
+    # me 可傳入已查得的資料，省去重新查詢；配對成功時回傳對方資料，否則回傳 None
+    conn = get_db_conn()
+    cur = conn.cursor()
+    # 只在本交易內限制等鎖時間，逾時由呼叫端（定期掃描、背景配對）處理
+    cur.execute("SET LOCAL lock_timeout = %s", (MATCH_LOCK_TIMEOUT,))
+    if me is None:
+        cur.execute(f"SELECT {REQUEST_COLUMNS} FROM exchange_requests WHERE id = %s", (new_id,))
+        me = cur.fetchone()
+    if not me or me["status"] != "pending":
+        conn.rollback()
+        cur.close()
+        return None
 
+    _matched_me, other = claim_match(cur, me)
     if not other:
+        conn.rollback()
         cur.close()
-        conn.close()
-        return False
-
-    match_id = min(me["id"], other["id"])
-    cur.execute(
-        "UPDATE exchange_requests SET status = 'matched', match_id = %s WHERE id IN (%s, %s)",
-        (match_id, me["id"], other["id"]),
-    )
+        return None
     conn.commit()
     cur.close()
-    conn.close()
 
-    try:
-        msg_to_me = build_match_message(me, other)
-        msg_to_other = build_match_message(other, me)
-        line_bot_api.push_message(me["line_user_id"], TextSendMessage(text=msg_to_me))
-        line_bot_api.push_message(other["line_user_id"], TextSendMessage(text=msg_to_other))
-    except Exception as exc:
-        print("push_message 發送失敗：", exc)
+    notify_match(me, other)
+    return other
+
+
+def run_match_in_background(req_id: int, me=None):
+    with app.app_context():
+        try:
+            try_match_and_notify(req_id, me)
+        except Exception as exc:
+            print("背景配對失敗：", exc)
 
-    return True
+
+def try_match_async(req_id: int, me=None):
+    match_executor.submit(run_match_in_background, req_id, me)
 
 
 def build_confirm_message(req) -> str:
-    data = {key: req[key] for key, _ in FIELD_FLOW}
-    summary = format_summary(data)
+    summary = format_summary(req)
     return (
         "登記完成！以下是您的資料，請確認：\n"
         f"{summary}\n"
@@ -721,6 +899,9 @@ def build_help_message() -> str:
     )
 
 
+HELP_MESSAGE = build_help_message()
+
+
 init_db()
 
 match_thread = threading.Thread(target=periodic_match_loop, daemon=True)
@@ -746,7 +927,7 @@ def handle_message(event):
     text = event.message.text.strip()
 
     if text.startswith("取消"):
-        user_states.pop(user_id, None)
+        clear_user_mode(user_id)
         parts = text.split()
         if len(parts) < 2:
             reply = "取消請輸入：取消 訂單編號，例如:取消 987654321。"
@@ -774,7 +955,7 @@ def handle_message(event):
         return
 
     if text.startswith("查詢"):
-        user_states.pop(user_id, None)
+        clear_user_mode(user_id)
         parts = text.split()
         if len(parts) < 2:
             reply = "查詢請輸入：查詢 訂單編號，例如:查詢 987654321"
@@ -790,7 +971,7 @@ def handle_message(event):
 
         partner = get_partner(req) if req["status"] == "matched" else None
         status_text = "已配對" if req["status"] == "matched" else "待配對"
-        summary = format_summary({key: req[key] for key, _ in FIELD_FLOW})
+        summary = format_summary(req)
         base_msg = (
             f"訂單查詢結果（狀態：{status_text}）\n"
             f"{summary}"
@@ -811,7 +992,7 @@ def handle_message(event):
         return
 
     if text.startswith("解除"):
-        user_states.pop(user_id, None)
+        clear_user_mode(user_id)
         parts = text.split()
         if len(parts) < 3:
             reply = "解除請輸入：解除 我的訂單編號 對方訂單編號，例如:解除 987654321 552510329。"
@@ -830,52 +1011,53 @@ def handle_message(event):
         )
         line_bot_api.reply_message(event.reply_token, TextSendMessage(text=reply_me))
 
-        try:
-            msg_to_partner = (
-                "您的配對對象已解除配對，資料已回到待配對狀態，系統會重新為您尋找配對對象。\n"
-                f"訂單：{partner['order_no']}"
-            )
-            line_bot_api.push_message(partner["line_user_id"], TextSendMessage(text=msg_to_partner))
-        except Exception as exc:
-            print("push_message 發送解除通知失敗：", exc)
+        msg_to_partner = (
+            "您的配對對象已解除配對，資料已回到待配對狀態，系統會重新為您尋找配對對象。\n"
+            f"訂單：{partner['order_no']}"
+        )
+        push_text_async(partner["line_user_id"], msg_to_partner, "push_message 發送解除通知失敗：")
 
-        try_match_and_notify(me["id"])
-        try_match_and_notify(partner["id"])
+        try_match_async(me["id"])
+        try_match_async(partner["id"])
         return
 
     if text == "登記":
-        user_states[user_id] = {"mode": "await_form"}
+        set_user_mode(user_id, "await_form")
         intro = (
             "將為您進行扭蛋交換登記，請一次填寫以下 8 個欄位並直接回覆：\n"
             "注意：同一扭蛋訂單編號不可重複登記。\n"
-            f"{build_form_template()}\n\n"
+            f"{FORM_TEMPLATE}\n\n"
             f"{DISCLAIMER}"
         )
         line_bot_api.reply_message(event.reply_token, TextSendMessage(text=intro))
         return
 
-    state = user_states.get(user_id)
-    if state is not None and state.get("mode") == "await_form":
+    if get_user_mode(user_id) == "await_form":
         data, errors = parse_form_input(text)
         if order_no_exists(user_id, data.get("order_no", "")):
-            errors.append("此扭蛋訂單編號已登記，請使用不同的 9 碼編號。")
+            errors.append(DUPLICATE_ORDER_ERROR)
+
+        req = partner = None
+        if not errors:
+            req, partner = register_and_match(data, user_id)
+            if req is None:
+                errors.append(DUPLICATE_ORDER_ERROR)
 
         if errors:
-            prompt = "以下欄位需修正：\n" + "\n".join(errors) + f"\n\n請依下列格式重新輸入：\n{build_form_template()}"
+            prompt = "以下欄位需修正：\n" + "\n".join(errors) + f"\n\n請依下列格式重新輸入：\n{FORM_TEMPLATE}"
             line_bot_api.reply_message(event.reply_token, TextSendMessage(text=prompt))
             return
 
-        user_states.pop(user_id, None)
-        new_id = insert_request(data, user_id)
-        req = get_request_by_id(new_id)
+        clear_user_mode(user_id)
         confirm_msg = build_confirm_message(req)
         line_bot_api.reply_message(event.reply_token, TextSendMessage(text=confirm_msg))
-        try_match_and_notify(new_id)
+        if partner:
+            notify_match(req, partner)
         return
 
-    help_msg = build_help_message()
-    line_bot_api.reply_message(event.reply_token, TextSendMessage(text=help_msg))
+    line_bot_api.reply_message(event.reply_token, TextSendMessage(text=HELP_MESSAGE))
 
 
 if __name__ == "__main__":
+    # 僅供本機開發使用；正式環境請以 gunicorn wsgi:application 啟動
     app.run(host="0.0.0.0", port=int(os.environ.get("PORT", 8000)))
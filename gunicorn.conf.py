@@ -0,0 +1,13 @@
+import os
+
+# 正式環境以 Gunicorn 啟動：gunicorn wsgi:application（自動讀取本設定檔）
+bind = os.getenv("GUNICORN_BIND", f"0.0.0.0:{os.getenv('PORT', '8000')}")
+
+# gthread worker：同一 worker 內以多執行緒並行處理 webhook，連線維持 keep-alive
+worker_class = "gthread"
+# 未設定 REDIS_URL 時 user_states 存放於各 worker 記憶體中不共享，預設僅啟動 1 個 worker；
+# 設定 REDIS_URL 後可透過 WEB_CONCURRENCY 增加 worker 數
+workers = int(os.getenv("WEB_CONCURRENCY", "1"))
+threads = int(os.getenv("GUNICORN_THREADS", "8"))
+keepalive = 30
+timeout = 30
@@ -4,6 +4,8 @@ import psycopg2
 import psycopg2.extras
 from dotenv import load_dotenv
 
+from schema import ensure_schema
+
 load_dotenv()
 
 DATABASE_URL = os.getenv("DATABASE_URL")
@@ -11,48 +13,49 @@ DATABASE_URL = os.getenv("DATABASE_URL")
 if not DATABASE_URL:
     raise RuntimeError("未設定 DATABASE_URL，請先於環境變數設定 PostgreSQL 連線字串")
 
+# 建立 idx_exchange_user_order 前清除舊資料中的重複登記：同一 (line_user_id, order_no) 只保留一筆，
+# 優先保留已配對的資料，其次保留 id 最大的一筆（與 get_request_by_order 一致）；已配對的資料一律不刪
+DEDUPE_ORDERS_SQL = """
+WITH ranked AS (
+    SELECT id, ROW_NUMBER() OVER (
+        PARTITION BY line_user_id, order_no
+        ORDER BY (status = 'matched') DESC, id DESC
+    ) AS rn
+    FROM exchange_requests
+)
+DELETE FROM exchange_requests e
+USING ranked
+WHERE e.id = ranked.id AND ranked.rn > 1 AND e.status <> 'matched'
+RETURNING e.id, e.line_user_id, e.order_no, e.status
+"""
+
 conn = psycopg2.connect(DATABASE_URL, cursor_factory=psycopg2.extras.DictCursor)
 cur = conn.cursor()
 
-cur.execute(
-    """
-    CREATE TABLE IF NOT EXISTS exchange_requests (
-        id SERIAL PRIMARY KEY,
-        line_user_id TEXT NOT NULL,
-        contact TEXT NOT NULL,
-        order_no TEXT NOT NULL,
-        orig_date TEXT NOT NULL,
-        orig_slot TEXT NOT NULL,
-        orig_place TEXT NOT NULL DEFAULT '',
-        desired_date TEXT NOT NULL,
-        desired_slot TEXT NOT NULL,
-        desired_place TEXT NOT NULL DEFAULT '',
-        verif_code TEXT NOT NULL,
-        status TEXT NOT NULL DEFAULT 'pending',
-        match_id INTEGER,
-        created_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
-    )
-    """
-)
-
-cur.execute("ALTER TABLE exchange_requests ADD COLUMN IF NOT EXISTS orig_place TEXT NOT NULL DEFAULT ''")
-cur.execute("ALTER TABLE exchange_requests ADD COLUMN IF NOT EXISTS desired_place TEXT NOT NULL DEFAULT ''")
-cur.execute("ALTER TABLE exchange_requests ADD COLUMN IF NOT EXISTS created_at TIMESTAMPTZ NOT NULL DEFAULT NOW()")
-cur.execute("ALTER TABLE exchange_requests DROP COLUMN IF EXISTS phone")
-cur.execute("ALTER TABLE exchange_requests DROP COLUMN IF EXISTS email")
-
-cur.execute(
-    """
-    CREATE TABLE IF NOT EXISTS match_blocks (
-        id SERIAL PRIMARY KEY,
-        req_id_a INTEGER NOT NULL,
-        req_id_b INTEGER NOT NULL,
-        created_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
-        CONSTRAINT uniq_pair UNIQUE (req_id_a, req_id_b)
+cur.execute("SELECT to_regclass('exchange_requests') IS NOT NULL AS exists")
+if cur.fetchone()["exists"]:
+    cur.execute(DEDUPE_ORDERS_SQL)
+    for row in cur.fetchall():
+        print(f"刪除重複登記：id={row['id']} user={row['line_user_id']} 訂單={row['order_no']} 狀態={row['status']}")
+    conn.commit()
+
+ensure_schema(conn)
+
+cur.execute("SELECT to_regclass('idx_exchange_user_order') IS NOT NULL AS exists")
+if not cur.fetchone()["exists"]:
+    # 同一訂單有多筆已配對資料時無法自動判斷保留哪一筆，需人工處理
+    cur.execute(
+        """
+        SELECT line_user_id, order_no, array_agg(id ORDER BY id) AS ids
+        FROM exchange_requests GROUP BY line_user_id, order_no HAVING COUNT(*) > 1
+        """
     )
-    """
-)
+    for row in cur.fetchall():
+        print(f"仍有重複的已配對登記，請人工處理：user={row['line_user_id']} 訂單={row['order_no']} id={row['ids']}")
+conn.commit()
 
+# 建立索引與回填後更新統計資料，讓查詢規劃器選用新索引
+cur.execute("ANALYZE exchange_requests; ANALYZE desired_slots;")
 conn.commit()
 cur.close()
 conn.close()
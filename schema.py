@@ -0,0 +1,92 @@
+# 資料庫結構定義，app.py 與 init_db.py 共用
+
+# 建表、欄位遷移與索引合併為一段 SQL，啟動時一次送出並在同一交易內完成
+SCHEMA_SQL = """
+-- 多個 worker 同時啟動時依序執行
+SELECT pg_advisory_xact_lock(20251201);
+
+CREATE TABLE IF NOT EXISTS exchange_requests (
+    id SERIAL PRIMARY KEY,
+    line_user_id TEXT NOT NULL,
+    contact TEXT NOT NULL,
+    order_no TEXT NOT NULL,
+    orig_date TEXT NOT NULL,
+    orig_slot TEXT NOT NULL,
+    orig_place TEXT NOT NULL DEFAULT '',
+    desired_date TEXT NOT NULL,
+    desired_slot TEXT NOT NULL,
+    desired_place TEXT NOT NULL DEFAULT '',
+    status TEXT NOT NULL DEFAULT 'pending',
+    match_id INTEGER,
+    created_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+);
+ALTER TABLE exchange_requests ADD COLUMN IF NOT EXISTS orig_place TEXT NOT NULL DEFAULT '';
+ALTER TABLE exchange_requests ADD COLUMN IF NOT EXISTS desired_place TEXT NOT NULL DEFAULT '';
+ALTER TABLE exchange_requests ADD COLUMN IF NOT EXISTS created_at TIMESTAMPTZ NOT NULL DEFAULT NOW();
+ALTER TABLE exchange_requests DROP COLUMN IF EXISTS verif_code;
+ALTER TABLE exchange_requests DROP COLUMN IF EXISTS phone;
+ALTER TABLE exchange_requests DROP COLUMN IF EXISTS email;
+
+CREATE TABLE IF NOT EXISTS match_blocks (
+    id SERIAL PRIMARY KEY,
+    req_id_a INTEGER NOT NULL,
+    req_id_b INTEGER NOT NULL,
+    created_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+    CONSTRAINT uniq_pair UNIQUE (req_id_a, req_id_b)
+);
+
+CREATE INDEX IF NOT EXISTS idx_exchange_user_status ON exchange_requests (line_user_id, status);
+-- 舊資料可能已有重複登記，此時不建唯一索引、也不在啟動時刪資料，改由 init_db.py 清理後再建立
+DO $$
+BEGIN
+    IF to_regclass('idx_exchange_user_order') IS NULL THEN
+        IF EXISTS (
+            SELECT 1 FROM exchange_requests GROUP BY line_user_id, order_no HAVING COUNT(*) > 1
+        ) THEN
+            RAISE WARNING '發現重複的 (line_user_id, order_no) 登記，暫不建立 idx_exchange_user_order，請執行 init_db.py 清理';
+        ELSE
+            CREATE UNIQUE INDEX idx_exchange_user_order ON exchange_requests (line_user_id, order_no);
+        END IF;
+    END IF;
+END $$;
+-- 配對掃描只看 pending 資料，部分索引同時提供 created_at 排序
+CREATE INDEX IF NOT EXISTS idx_exchange_pending ON exchange_requests (created_at, id) WHERE status = 'pending';
+CREATE INDEX IF NOT EXISTS idx_exchange_match_id ON exchange_requests (match_id) WHERE match_id IS NOT NULL;
+-- 配對查詢：以對方的原登記日期/時段/地點反查待配對資料
+CREATE INDEX IF NOT EXISTS idx_exchange_pending_orig
+    ON exchange_requests (orig_date, orig_slot, orig_place) WHERE status = 'pending';
+
+-- 希望交換的日期/時段逐筆拆開存放，讓配對改由索引查詢
+CREATE TABLE IF NOT EXISTS desired_slots (
+    req_id INTEGER NOT NULL REFERENCES exchange_requests (id) ON DELETE CASCADE,
+    desired_date TEXT NOT NULL,
+    desired_slot TEXT NOT NULL,
+    PRIMARY KEY (req_id, desired_date, desired_slot)
+);
+CREATE INDEX IF NOT EXISTS idx_desired_slots_lookup ON desired_slots (desired_date, desired_slot, req_id);
+
+-- 補齊舊資料的 desired_slots
+INSERT INTO desired_slots (req_id, desired_date, desired_slot)
+SELECT r.id, TRIM(p.desired_date), TRIM(p.desired_slot)
+FROM exchange_requests r
+CROSS JOIN LATERAL unnest(
+    regexp_split_to_array(r.desired_date, '[、,]'),
+    regexp_split_to_array(r.desired_slot, '[、,]')
+) AS p (desired_date, desired_slot)
+WHERE TRIM(p.desired_date) <> '' AND TRIM(p.desired_slot) <> ''
+  AND NOT EXISTS (SELECT 1 FROM desired_slots ds WHERE ds.req_id = r.id)
+ON CONFLICT DO NOTHING;
+"""
+
+
+def ensure_schema(conn):
+    # 建表、遷移與索引皆為冪等操作，可重複執行
+    cur = conn.cursor()
+    cur.execute(SCHEMA_SQL)
+    conn.commit()
+    cur.close()
+    # IF NOT EXISTS 產生的 NOTICE 不必顯示，只印出需處理的 WARNING（例如重複登記）
+    for notice in conn.notices:
+        if notice.startswith("WARNING"):
+            print(notice.strip())
+    del conn.notices[:]
@@ -0,0 +1,4 @@
+from app import app
+
+# Gunicorn 入口：gunicorn wsgi:application
+application = app